@@ -1,5 +1,6 @@
 from postgres_da_ai_agent.modules.db import PostgresManager
 from postgres_da_ai_agent.modules import file
+from contextlib import suppress
 import os
 
 BASE_DIR = os.environ.get("BASE_DIR", "./agent_results")
@@ -118,13 +119,20 @@ class PostgresAgentInstruments(AgentInstruments):
         """
         Run a SQL query against the postgres database
         """
-        results_as_json = self.db.run_sql(sql)
-
         fname = self.run_sql_results_file
-
-        # dump these results to a file
-        with open(fname, "w") as f:
-            f.write(results_as_json)
+        tmp_fname = fname + ".tmp"
+
+        # stream these results to a temp file and only replace the results file
+        # once the query has fully succeeded, so a failure never leaves partial json
+        try:
+            with open(tmp_fname, "w") as f:
+                self.db.stream_sql(sql, f)
+        except Exception:
+            # open() itself may have failed, leaving nothing to clean up
+            with suppress(FileNotFoundError):
+                os.remove(tmp_fname)
+            raise
+        os.replace(tmp_fname, fname)
 
         with open(self.sql_query_file, "w") as f:
             f.write(sql)
@@ -0,0 +1,92 @@
+import asyncio
+import asyncpg
+
+from postgres_da_ai_agent.modules.db import (
+    GET_ALL_TABLE_DEFINITIONS_SQL,
+    GET_ALL_TABLE_NAMES_SQL,
+    GET_RELATED_TABLES_SQL,
+    GET_TABLE_DEFINITION_SQL,
+    PostgresManager,
+)
+
+
+class AsyncPostgresManager:
+    """
+    An asyncpg backed manager that runs catalog queries concurrently over a connection pool
+    """
+
+    def __init__(self):
+        self.pool = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def connect_with_url(self, url, min_size=4, max_size=16):
+        self.pool = await asyncpg.create_pool(url, min_size=min_size, max_size=max_size)
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def fetch(self, query, *args):
+        """
+        Run a query on a pooled connection
+
+        asyncpg prepares each query once and keeps it in the connection's statement cache
+        """
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+    async def get_table_definition(self, table_name):
+        """
+        Generate the 'create' definition for a table
+        """
+        rows = await self.fetch(GET_TABLE_DEFINITION_SQL, table_name)
+        return rows[0][0] if rows else None
+
+    async def get_table_definitions(self, table_names):
+        """
+        Fetch the 'create' definitions for the given tables concurrently
+        """
+        definitions = await asyncio.gather(
+            *[self.get_table_definition(table_name) for table_name in table_names]
+        )
+        return dict(zip(table_names, definitions))
+
+    async def get_all_table_definitions(self):
+        """
+        Get the 'create' definition of every table in a single catalog scan
+        """
+        rows = await self.fetch(GET_ALL_TABLE_DEFINITIONS_SQL)
+        return {row[0]: row[1] for row in sorted(rows, key=lambda row: row[0])}
+
+    async def get_all_table_names(self):
+        """
+        Get all table names in the database
+        """
+        rows = await self.fetch(GET_ALL_TABLE_NAMES_SQL)
+        return [row[0] for row in rows]
+
+    async def get_table_definitions_for_prompt(self):
+        """
+        Get all table 'create' definitions in the database
+        """
+        definitions = await self.get_table_definition_map_for_embeddings()
+        return "\n\n".join(definitions.values())
+
+    async def get_table_definition_map_for_embeddings(self):
+        """
+        Creates a map of table names to table definitions
+        """
+        return await self.get_all_table_definitions()
+
+    async def get_related_tables(self, table_list, n=2):
+        """
+        Get tables that have foreign keys referencing the given table
+        """
+        rows = await self.fetch(GET_RELATED_TABLES_SQL, list(table_list))
+        return PostgresManager.collect_related_tables(rows, table_list, n)
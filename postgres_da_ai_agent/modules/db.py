@@ -1,7 +1,121 @@
-from datetime import datetime
-import json
-import psycopg2
-from psycopg2.sql import SQL, Identifier
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time
+import io
+from itertools import islice
+import threading
+import time
+from typing import TYPE_CHECKING
+import orjson
+import psycopg
+from psycopg.pq import Format
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+def json_default(obj):
+    """
+    Fallback for values orjson can't encode natively, e.g. Decimal
+    """
+    # only reached with OPT_PASSTHROUGH_DATETIME, see dump_row
+    if isinstance(obj, (datetime, date, dt_time)):
+        return obj.isoformat()
+    return str(obj)
+
+
+def dump_row(row) -> str:
+    """
+    Encode a result row as JSON with orjson
+    """
+    try:
+        return orjson.dumps(row, default=json_default).decode()
+    except TypeError:
+        # orjson rejects some values without consulting default, e.g. a timetz
+        # with a fixed-offset tzinfo, so retry with datetimes isoformatted by json_default
+        return orjson.dumps(
+            row, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME
+        ).decode()
+
+
+# postgres renders the 'create' definition itself, one row per table
+TABLE_DEFINITION_EXPR = """
+    'CREATE TABLE ' || quote_ident(c.relname) || E' (\\n'
+    || string_agg(
+        quote_ident(a.attname) || ' ' || format_type(a.atttypid, a.atttypmod),
+        E',\\n' ORDER BY a.attnum
+    )
+    || E'\\n);'"""
+
+GET_TABLE_DEFINITION_SQL = f"""
+SELECT{TABLE_DEFINITION_EXPR} as definition
+FROM
+    pg_class c
+JOIN
+    pg_namespace n ON n.oid = c.relnamespace
+JOIN
+    pg_attribute a ON a.attrelid = c.oid
+WHERE
+    c.relkind = 'f'
+    AND n.nspname = 'akeyless'
+    AND c.relname = $1
+    AND a.attnum > 0
+    AND NOT a.attisdropped
+GROUP BY
+    c.relname
+"""
+
+GET_ALL_TABLE_DEFINITIONS_SQL = f"""
+SELECT
+    c.relname as table_name,{TABLE_DEFINITION_EXPR} as definition
+FROM
+    pg_class c
+JOIN
+    pg_namespace n ON n.oid = c.relnamespace
+JOIN
+    pg_attribute a ON a.attrelid = c.oid
+WHERE
+    c.relkind = 'f'
+    AND n.nspname = 'akeyless'
+    AND a.attnum > 0
+    AND NOT a.attisdropped
+GROUP BY
+    c.relname
+"""
+
+GET_ALL_TABLE_NAMES_SQL = """
+SELECT c.relname
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'f' AND n.nspname = 'akeyless'
+"""
+
+# every foreign key edge touching the given foreign tables, in both directions
+GET_RELATED_TABLES_SQL = """
+SELECT 
+    src.relname AS table_name,
+    ref.relname AS referenced_table_name
+FROM 
+    pg_constraint con 
+    JOIN pg_class src ON src.oid = con.conrelid 
+    JOIN pg_class ref ON ref.oid = con.confrelid 
+    JOIN pg_namespace src_n ON src_n.oid = src.relnamespace 
+    JOIN pg_namespace ref_n ON ref_n.oid = ref.relnamespace 
+WHERE 
+    con.contype = 'f'
+    -- both ends must be tables GET_ALL_TABLE_NAMES_SQL returns
+    AND src.relkind = 'f' AND src_n.nspname = 'akeyless'
+    AND ref.relkind = 'f' AND ref_n.nspname = 'akeyless'
+    AND (src.relname = ANY($1) OR ref.relname = ANY($1))
+"""
+
+# encoded once at import; psycopg sends bytes queries as-is instead of encoding the text on every execute
+_GET_TABLE_DEFINITION_QUERY = GET_TABLE_DEFINITION_SQL.encode()
+_GET_ALL_TABLE_DEFINITIONS_QUERY = GET_ALL_TABLE_DEFINITIONS_SQL.encode()
+_GET_ALL_TABLE_NAMES_QUERY = GET_ALL_TABLE_NAMES_SQL.encode()
+_GET_RELATED_TABLES_QUERY = GET_RELATED_TABLES_SQL.encode()
 
 
 class PostgresManager:
@@ -9,233 +123,374 @@ class PostgresManager:
     A class to manage postgres connections and queries
     """
 
-    def __init__(self):
+    # url -> connection pool shared by every manager in the process, created lazily
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    # most recently used table definitions kept per manager
+    TABLE_DEFINITION_CACHE_SIZE = 4096
+
+    def __init__(self, schema_ttl=60):
         self.conn = None
         self.cur = None
+        self._pool = None
+        # seconds catalog results are reused before being re-queried
+        self.schema_ttl = schema_ttl
+        self.invalidate_schema_cache()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.cur:
-            self.cur.close()
-        if self.conn:
-            self.conn.close()
+        self.close()
+
+    def connect_with_url(self, url, minconn=1, maxconn=10, timeout=30.0):
+        with PostgresManager._pools_lock:
+            pool = PostgresManager._pools.get(url)
+            if pool is None:
+                pool = self._open_pool(url, minconn, maxconn, timeout)
+                PostgresManager._pools[url] = pool
+        self._pool = pool
+        self.conn = pool.getconn()
+        self.cur = self.catalog_cursor()
+
+    @staticmethod
+    def _open_pool(url, minconn, maxconn, timeout):
+        # connect once up front: a bad url fails here straight away with the real
+        # OperationalError, where the pool would keep retrying until it times out
+        psycopg.connect(url).close()
+
+        # autocommit so connections go back to the pool idle rather than
+        # in a transaction, whose rollback would also drop prepared statements
+        pool = ConnectionPool(
+            url,
+            min_size=minconn,
+            max_size=maxconn,
+            kwargs={"autocommit": True},
+            open=False,
+        )
+        try:
+            pool.open(wait=True, timeout=timeout)
+        except Exception:
+            # stop the background workers so a broken pool isn't left retrying
+            pool.close()
+            raise
+        return pool
+
+    def catalog_cursor(self):
+        """
+        A cursor for the catalog queries, which use server-side $1 placeholders shared with asyncpg
+        """
+        return psycopg.RawCursor(self.conn)
+
+    def execute_catalog(self, cur, query, params=None):
+        """
+        Run a catalog query as a server-side prepared statement
+
+        psycopg keeps the statement prepared on the connection, so repeated calls
+        (and later checkouts of the same pooled connection) skip parse + plan
+        """
+        cur.execute(query, params, prepare=True, binary=True)
+
+    @contextmanager
+    def read_only_transaction(self):
+        """
+        A transaction for agent-written SQL that can't persist any writes
 
-    def connect_with_url(self, url):
-        self.conn = psycopg2.connect(url)
-        self.cur = self.conn.cursor()
+        It commits rather than rolls back on success, as a rollback would also
+        drop psycopg's prepared statements for the catalog queries
+        """
+        with self.conn.transaction():
+            self.conn.execute("SET TRANSACTION READ ONLY")
+            yield
 
     def close(self):
+        """
+        Return the connection to the pool
+        """
         if self.cur:
             self.cur.close()
+            self.cur = None
         if self.conn:
-            self.conn.close()
+            self._pool.putconn(self.conn)
+            self.conn = None
 
-    def run_sql(self, sql) -> str:
+    def invalidate_schema_cache(self):
         """
-        Run a SQL query against the postgres database
+        Drop cached catalog results so the next metadata call re-queries the database
         """
-        self.cur.execute(sql)
-        columns = [desc[0] for desc in self.cur.description]
-        res = self.cur.fetchall()
+        self._table_names_cache = None
+        self._all_table_defs_cache = None
+        self.clear_cache()
+        self._schema_cached_at = time.monotonic()
 
-        list_of_dicts = [dict(zip(columns, row)) for row in res]
+    def clear_cache(self):
+        """
+        Drop the LRU cache of per-table definitions
+        """
+        self._table_def_cache = OrderedDict()
 
-        json_result = json.dumps(list_of_dicts, indent=4, default=self.datetime_handler)
+    def _cache_table_definition(self, table_name, definition):
+        self._table_def_cache[table_name] = definition
+        self._table_def_cache.move_to_end(table_name)
+        if len(self._table_def_cache) > self.TABLE_DEFINITION_CACHE_SIZE:
+            self._table_def_cache.popitem(last=False)
 
-        return json_result
+    def _expire_schema_cache(self):
+        if time.monotonic() - self._schema_cached_at > self.schema_ttl:
+            self.invalidate_schema_cache()
 
-    def datetime_handler(self, obj):
+    @classmethod
+    def close_all_pools(cls):
         """
-        Handle datetime objects when serializing to JSON.
+        Close every pooled connection, e.g. on process shutdown
         """
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return str(obj)  # or just return the object unchanged, or another default value
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                pool.close()
+            cls._pools.clear()
+
+    def run_sql(self, sql) -> str:
+        """
+        Run a SQL query against the postgres database
+        """
+        buffer = io.StringIO()
+        self.stream_sql(sql, buffer)
+        return buffer.getvalue()
+
+    def stream_sql(self, sql, out, itersize=10000):
+        """
+        Run a SQL query and write the results to a file-like object as a JSON list
+
+        Rows are pulled through a server-side cursor itersize at a time so the
+        full result set is never held in memory, inside a read-only transaction.
+        Statements a cursor can't wrap (EXPLAIN, SHOW, data-modifying WITH, ...)
+        fall back to a regular client-side cursor and are always rolled back, so
+        neither path persists writes.
+        """
+        declared = False
+        try:
+            # a named cursor needs a transaction on the autocommit connection
+            with self.read_only_transaction():
+                # dict_row builds each row dict inside psycopg instead of a per-row zip here.
+                # Results stay in text format: agent SQL can return types without a
+                # binary loader (money, point, ...), which would load as raw bytes
+                with self.conn.cursor(name="run_sql_stream", row_factory=dict_row) as cur:
+                    cur.execute(sql)
+                    declared = True
+                    self._write_rows(cur, out, itersize)
+            return
+        except (psycopg.errors.SyntaxError, psycopg.errors.FeatureNotSupported):
+            # DECLARE ... CURSOR FOR only accepts SELECT / VALUES without data-modifying WITH
+            if declared:
+                raise
+
+        with self.conn.transaction(force_rollback=True):
+            with self.conn.cursor(row_factory=dict_row) as cur:
+                cur.execute(sql)
+                self._write_rows(cur, out, itersize)
+
+    def _write_rows(self, cur, out, itersize):
+        # fetch before writing anything: a server-side cursor only raises
+        # runtime errors (division by zero, bad casts, ...) on FETCH
+        rows = cur.fetchmany(itersize) if cur.description else []
+
+        out.write("[")
+        first = True
+        while rows:
+            for row in rows:
+                if not first:
+                    out.write(",")
+                first = False
+                out.write(dump_row(row))
+            rows = cur.fetchmany(itersize)
+        out.write("]")
+
+    def run_sql_bulk(self, sql) -> dict:
+        """
+        Run a large SELECT and return its results as a dict of column name -> list of values
+
+        Rows are transferred with COPY in postgres' binary format so values skip
+        the text encode / parse round trip, falling back to a regular query when a
+        column type has no binary loader. The query runs in a read-only
+        transaction, and only queries that can be wrapped as a subquery are
+        supported; anything else (DDL, EXPLAIN, SHOW, ...) raises ValueError
+        and should go through run_sql.
+        """
+        query = sql.strip().rstrip(";")
+
+        with self.read_only_transaction():
+            # LIMIT 0 only plans the query, giving us the column names and type oids.
+            # The newline keeps a trailing -- comment from swallowing the closing paren
+            try:
+                self.cur.execute("SELECT * FROM ({}\n) AS bulk LIMIT 0".format(query))
+            except (psycopg.errors.SyntaxError, psycopg.errors.FeatureNotSupported) as e:
+                raise ValueError(
+                    "run_sql_bulk only supports SELECT-like queries, use run_sql instead"
+                ) from e
+            columns = [desc.name for desc in self.cur.description]
+            type_oids = [desc.type_code for desc in self.cur.description]
+            values = [[] for _ in columns]
+
+            if all(
+                self.conn.adapters.get_loader(type_oid, Format.BINARY)
+                for type_oid in type_oids
+            ):
+                with self.cur.copy(
+                    "COPY ({}\n) TO STDOUT WITH (FORMAT binary)".format(query)
+                ) as copy:
+                    copy.set_types(type_oids)
+                    self._append_columns(values, copy.rows())
+            else:
+                # some column has no binary loader, so fetch as text
+                self.cur.execute(query)
+                self._append_columns(values, self.cur)
+
+        return dict(zip(columns, values))
+
+    @staticmethod
+    def _append_columns(values, rows):
+        # spread each row over the column lists as it arrives, so only one copy is held
+        for row in rows:
+            for column, value in zip(values, row):
+                column.append(value)
 
     def get_table_definition(self, table_name):
         """
         Generate the 'create' definition for a table
         """
+        self._expire_schema_cache()
+        if table_name in self._table_def_cache:
+            self._table_def_cache.move_to_end(table_name)
+            return self._table_def_cache[table_name]
 
-        # get_def_stmt = """
-        # SELECT pg_class.relname as tablename,
-        #     pg_attribute.attnum,
-        #     pg_attribute.attname,
-        #     format_type(atttypid, atttypmod)
-        # FROM pg_class
-        # JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
-        # JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid
-        # WHERE pg_attribute.attnum > 0
-        #     AND pg_class.relname = %s
-        #     AND pg_namespace.nspname = 'public'  -- Assuming you're interested in public schema
-        # """
-
-        get_def_stmt = """
-        SELECT
-            ft.foreign_table_schema as schema_name,
-            ft.foreign_table_name as table_name,
-            a.attname as column_name,
-            format_type(a.atttypid, a.atttypmod) as column_type,
-            d.description as column_description
-        FROM
-            information_schema.foreign_tables ft
-        JOIN
-            pg_foreign_table pft ON ft.foreign_table_name = pft.ftrelid::regclass::text
-        JOIN
-            pg_attribute a ON a.attrelid = pft.ftrelid
-        LEFT JOIN
-            pg_description d ON a.attrelid = d.objoid AND a.attnum = d.objsubid
-        WHERE
-            ft.foreign_table_schema = 'akeyless'
-            AND a.attnum > 0
-        ORDER BY
-            ft.foreign_table_schema,
-            ft.foreign_table_name,
-            a.attnum;
-        """
-        self.cur.execute(get_def_stmt, (table_name,))
-        rows = self.cur.fetchall()
-        create_table_stmt = "CREATE TABLE {} (\n".format(table_name)
-        for row in rows:
-            create_table_stmt += "{} {},\n".format(row[2], row[3])
-        create_table_stmt = create_table_stmt.rstrip(",\n") + "\n);"
-        return create_table_stmt
+        definition = self._get_table_definition_uncached(table_name)
+        self._cache_table_definition(table_name, definition)
+        return definition
+
+    def _get_table_definition_uncached(self, table_name):
+        self.execute_catalog(self.cur, _GET_TABLE_DEFINITION_QUERY, (table_name,))
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def get_table_definitions(self, table_names):
+        """
+        Generate the 'create' definitions for the given tables
+
+        Uncached tables are queried in a single pipeline so the per-table
+        queries share one round trip instead of waiting on each other
+        """
+        self._expire_schema_cache()
+        # read cache hits up front, the fetched definitions below may evict them
+        hits = {}
+        missing = []
+        for name in table_names:
+            if name in self._table_def_cache:
+                self._table_def_cache.move_to_end(name)
+                hits[name] = self._table_def_cache[name]
+            else:
+                missing.append(name)
+
+        cursors = []
+        with self.conn.pipeline():
+            for table_name in missing:
+                cur = self.catalog_cursor()
+                self.execute_catalog(cur, _GET_TABLE_DEFINITION_QUERY, (table_name,))
+                cursors.append(cur)
+
+        fetched = {}
+        for table_name, cur in zip(missing, cursors):
+            with cur:
+                row = cur.fetchone()
+            fetched[table_name] = row[0] if row else None
+            self._cache_table_definition(table_name, fetched[table_name])
+
+        return {name: hits[name] if name in hits else fetched[name] for name in table_names}
+
+    def get_all_table_definitions(self):
+        """
+        Get the 'create' definition of every table in a single catalog scan
+
+        Returns a dict of table name -> 'create' definition
+        """
+        self._expire_schema_cache()
+        if self._all_table_defs_cache is None:
+            self.execute_catalog(self.cur, _GET_ALL_TABLE_DEFINITIONS_QUERY)
+            # sorting the few table rows here is cheaper than a Sort node over every attribute
+            rows = sorted(self.cur.fetchall(), key=lambda row: row[0])
+            self._all_table_defs_cache = dict(rows)
+        return self._all_table_defs_cache
 
     def get_all_table_names(self):
         """
         Get all table names in the database
         """
-        # get_all_tables_stmt = (
-        #     "SELECT tablename FROM pg_tables WHERE schemaname = 'public';"
-        # )
-        get_all_tables_stmt = (
-            "SELECT foreign_table_name FROM information_schema.foreign_tables WHERE foreign_table_schema = 'akeyless';"
-        )
-        self.cur.execute(get_all_tables_stmt)
-        return [row[0] for row in self.cur.fetchall()]
+        self._expire_schema_cache()
+        if self._table_names_cache is None:
+            self.execute_catalog(self.cur, _GET_ALL_TABLE_NAMES_QUERY)
+            self._table_names_cache = [row[0] for row in self.cur.fetchall()]
+        return self._table_names_cache
 
     def get_table_definitions_for_prompt(self):
         """
         Get all table 'create' definitions in the database
         """
-        table_names = self.get_all_table_names()
-        definitions = []
-        for table_name in table_names:
-            definitions.append(self.get_table_definition(table_name))
-        return "\n\n".join(definitions)
+        return "\n\n".join(self.get_all_table_definitions().values())
 
     def get_table_definition_map_for_embeddings(self):
         """
         Creates a map of table names to table definitions
         """
-        table_names = self.get_all_table_names()
-        definitions = {}
-        for table_name in table_names:
-            definitions[table_name] = self.get_table_definition(table_name)
-        return definitions
+        return dict(self.get_all_table_definitions())
+
+    def get_table_definition_arrow(self) -> "pa.Table":
+        """
+        Get all table 'create' definitions as a columnar (table_name, definition) arrow table
+
+        Embedders can pull every definition out in bulk with .column("definition").
+        The columns are copied from the cached dict, so this adds an arrow copy
+        next to the python strings rather than replacing them. Needs the optional
+        'arrow' extra (pyarrow)
+        """
+        # imported here so pyarrow stays optional
+        import pyarrow as pa
+
+        definitions = self.get_table_definition_map_for_embeddings()
+        return pa.Table.from_pydict(
+            {
+                "table_name": pa.array(list(definitions.keys()), type=pa.string()),
+                "definition": pa.array(list(definitions.values()), type=pa.string()),
+            }
+        )
 
     def get_related_tables(self, table_list, n=2):
         """
         Get tables that have foreign keys referencing the given table
         """
+        if not table_list:
+            return []
 
-        related_tables_dict = {}
+        self.execute_catalog(self.cur, _GET_RELATED_TABLES_QUERY, (list(table_list),))
+        return self.collect_related_tables(self.cur.fetchall(), table_list, n)
 
+    @staticmethod
+    def collect_related_tables(rows, table_list, n=2):
+        """
+        Reduce (table_name, referenced_table_name) foreign key edges to the unique tables related to table_list
+        """
+
+        # index the edges once by each end instead of rescanning rows per table
+        referencing = defaultdict(list)
+        referenced = defaultdict(list)
+        for src, ref in rows:
+            # tables that have foreign keys referencing the given table
+            referencing[ref].append(src)
+            # tables that the given table references
+            referenced[src].append(ref)
+
+        seen = set()
         for table in table_list:
-            # # Query to fetch tables that have foreign keys referencing the given table
-            # self.cur.execute(
-            #     """
-            #     SELECT 
-            #         a.relname AS table_name
-            #     FROM 
-            #         pg_constraint con 
-            #         JOIN pg_class a ON a.oid = con.conrelid 
-            #     WHERE 
-            #         confrelid = (SELECT oid FROM pg_class WHERE relname = %s)
-            #     LIMIT %s;
-            #     """,
-            #     (table, n),
-            # )
-
-
-            # Query to fetch foreign tables that have foreign keys referencing the given foreign table
-            self.cur.execute(
-                """
-                SELECT 
-                    ft.foreign_table_name AS table_name
-                FROM 
-                    information_schema.foreign_table_constraints AS ftc
-                    JOIN information_schema.foreign_tables AS ft 
-                        ON ft.foreign_table_name = ftc.foreign_table_name
-                        AND ft.foreign_table_schema = ftc.foreign_table_schema
-                WHERE 
-                    ftc.unique_constraint_schema = 'akeyless'
-                    AND ftc.unique_constraint_name = (
-                        SELECT 
-                            tc.constraint_name 
-                        FROM 
-                            information_schema.table_constraints AS tc
-                            JOIN information_schema.constraint_column_usage AS ccu 
-                                ON ccu.constraint_name = tc.constraint_name
-                        WHERE 
-                            tc.constraint_schema = 'akeyless'
-                            AND tc.table_name = %s
-                            AND tc.constraint_type = 'FOREIGN KEY'
-                    )
-                LIMIT %s;
-                """,
-                (table, n),
-            )
-
-            related_tables = [row[0] for row in self.cur.fetchall()]
-
-            # # Query to fetch tables that the given table references
-            # self.cur.execute(
-            #     """
-            #     SELECT 
-            #         a.relname AS referenced_table_name
-            #     FROM 
-            #         pg_constraint con 
-            #         JOIN pg_class a ON a.oid = con.confrelid 
-            #     WHERE 
-            #         conrelid = (SELECT oid FROM pg_class WHERE relname = %s)
-            #     LIMIT %s;
-            #     """,
-            #     (table, n),
-            # )
-
-
-            # Query to fetch foreign tables that the given foreign table references
-            self.cur.execute(
-                """
-                SELECT 
-                    ft.foreign_table_name AS referenced_table_name
-                FROM 
-                    information_schema.foreign_table_constraints AS ftc
-                    JOIN information_schema.foreign_tables AS ft 
-                        ON ft.foreign_table_name = ftc.referenced_table_name
-                        AND ft.foreign_table_schema = ftc.referenced_table_schema
-                WHERE 
-                    ftc.foreign_table_schema = 'akeyless'
-                    AND ftc.foreign_table_name = %s
-                    AND ftc.constraint_type = 'FOREIGN KEY'
-                LIMIT %s;
-                """,
-                (table, n),
-            )
-
-
-            related_tables += [row[0] for row in self.cur.fetchall()]
-
-            related_tables_dict[table] = related_tables
-
-        # convert dict to list and remove dups
-        related_tables_list = []
-        for table, related_tables in related_tables_dict.items():
-            related_tables_list += related_tables
-
-        related_tables_list = list(set(related_tables_list))
-
-        return related_tables_list
+            seen.update(islice(referencing[table], n))
+            seen.update(islice(referenced[table], n))
+
+        return list(seen)